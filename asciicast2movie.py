@@ -8,12 +8,15 @@ Can be used as command line tool for convert asciicast file to video files:
 
 Can be also imported as a module and contains functions:
   * asciicast2video - convert asciicast data to moviepy video clip
+  * asciicast2mp4 - convert asciicast data to video file
 
 Requires:
   * pyte (https://pypi.org/project/pyte/) VTXXX terminal emulator
   * tty2img (https://pypi.org/project/tty2img/) lib for rendering pyte screen as image
   * moviepy (https://pypi.org/project/moviepy/) video editing library
   * numpy (https://pypi.org/project/numpy/) array computing (for moviepy)
+  * orjson (https://pypi.org/project/orjson/) fast JSON library
+    (optional, for faster asciicast parsing)
 
 Copyright © 2020, Robert Ryszard Paciorek <rrp@opcode.eu.org>, MIT licence
 '''
@@ -21,8 +24,15 @@ Copyright © 2020, Robert Ryszard Paciorek <rrp@opcode.eu.org>, MIT licence
 import pyte
 import tty2img
 import moviepy.editor as mpy
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 import numpy
-import io, json, math
+import bisect, functools, itertools, json, math, multiprocessing, pickle, types
+
+try:
+	import orjson
+	_jsonLoads = orjson.loads
+except ModuleNotFoundError:
+	_jsonLoads = json.loads
 
 def render_asciicast_frames(
 		inputData,
@@ -30,7 +40,8 @@ def render_asciicast_frames(
 		stream,
 		blinkingCursor = None,
 		lastFrameDuration = 3,
-		renderOptions = {}
+		renderOptions = {},
+		processes = 1
 	):
 	'''Convert asciicast frames data to moviepy video clip
 	
@@ -43,6 +54,7 @@ def render_asciicast_frames(
 	        for frame i (no header)
 	screen : pyte screen object
 	    used as emulated terminal screen
+	    (its dirty set is kept, with lines changed by inputData added)
 	stream : pyte stream object
 	    used as emulated terminal input stream
 	blinkingCursor : float, optional
@@ -51,20 +63,61 @@ def render_asciicast_frames(
 	    last frame duration time in seconds
 	renderOptions : dict, optional
 	    options passed to tty2img
+	processes : int, optional
+	    number of processes used for rendering frames images
+	    when 1 (default) render in current process, when None use number of CPUs,
+	    pool is used only when renderOptions can be pickled (e.g. logFunction
+	    is not lambda) and needs `if __name__ == "__main__":` guard in caller
+	    script on platforms using spawn start method (Windows, macOS)
 	
 	Returns
 	-------
 	    moviepy video clip
 	'''
-	clips = []
-	nextFrameStartTimes = list( zip(*inputData[1:], [ inputData[-1][0] + lastFrameDuration ]) )[0]
+	images, imageIndexes, durations = _renderFrames(
+		inputData, screen, stream, blinkingCursor, lastFrameDuration, renderOptions, processes
+	)
+	
+	# create video clip
+	# (frame for time t is found by binary search over subframes end times)
+	endTimes  = list(itertools.accumulate(durations))
+	lastIndex = len(endTimes) - 1
+	
+	def make_frame(t):
+		return images[ imageIndexes[ min(bisect.bisect_right(endTimes, t), lastIndex) ] ]
+	
+	return mpy.VideoClip(make_frame, duration=endTimes[-1])
+
+def _renderFrames(inputData, screen, stream, blinkingCursor, lastFrameDuration, renderOptions, processes):
+	'''Render asciicast frames (see render_asciicast_frames)
+	
+	Returns
+	-------
+	    tuple (images, imageIndexes, durations)
+	        list of rendered unique images (RGB numpy arrays)
+	        and for each subframe: index of its image and its duration
+	'''
+	# feed terminal emulator and collect screens to render
+	# (images from previous frame are reused when screen is unchanged)
+	# screen.dirty is cleared to detect changes between frames,
+	# so dirty lines are collected and restored at end for caller
+	renderJobs, clipsData = [], []
+	dirtyLines = set(screen.dirty)
+	nextFrameStartTimes = [ frame[0] for frame in inputData[1:] ] + [ inputData[-1][0] + lastFrameDuration ]
+	imageStatic, imageCursorOn, imageCursorOff, lastCursorState = None, None, None, None
 	for frame, endTime in zip(inputData, nextFrameStartTimes):
 		startTime = frame[0]
 		cursor = 0
 		
-		# prepare current frame image clips
+		# prepare current frame images
 		stream.feed(frame[-1])
-		imageClip, imageCursorOn, imageCursorOff = None, None, None
+		cursorState = (screen.cursor.x, screen.cursor.y, screen.cursor.hidden)
+		if screen.dirty or cursorState != lastCursorState:
+			dirtyLines.update(screen.dirty)
+			screen.dirty.clear()
+			snapshot = _ScreenSnapshot(screen)
+			imageStatic, imageCursorOn, imageCursorOff = None, None, None
+		lastCursorState = cursorState
 		while startTime < endTime:
 			# blinking cursor support
 			if blinkingCursor and (not screen.cursor.hidden):
@@ -82,23 +135,56 @@ def render_asciicast_frames(
 				# switch cursor
 				if cursor%2 == 0:
 					if imageCursorOn == None:
-						imageCursorOn = tty2img.tty2img(screen, showCursor=True, **renderOptions)
-						imageCursorOn = mpy.ImageClip(numpy.array( imageCursorOn ))
-					imageClip = imageCursorOn
+						imageCursorOn = len(renderJobs)
+						renderJobs.append( (snapshot, dict(renderOptions, showCursor=True)) )
+					imageIndex = imageCursorOn
 				else:
 					if imageCursorOff == None:
-						imageCursorOff = tty2img.tty2img(screen, showCursor=False, **renderOptions)
-						imageCursorOff = mpy.ImageClip(numpy.array( imageCursorOff ))
-					imageClip = imageCursorOff
+						imageCursorOff = len(renderJobs)
+						renderJobs.append( (snapshot, dict(renderOptions, showCursor=False)) )
+					imageIndex = imageCursorOff
 				cursor += 1
 			else:
-				imageClip = mpy.ImageClip(numpy.array( tty2img.tty2img(screen, **renderOptions) ))
+				if imageStatic == None:
+					imageStatic = len(renderJobs)
+					renderJobs.append( (snapshot, renderOptions) )
+				imageIndex = imageStatic
 				duration  = endTime-startTime
 				startTime = endTime
-			# subframe rendering
-			clips.append( imageClip.set_duration(duration) )
+			# subframe
+			clipsData.append( (imageIndex, duration) )
+	screen.dirty.update(dirtyLines)
+	
+	# render images (consecutive screens use this same tty2img renderState,
+	# pool workers get own copies of empty renderState with pickled function)
+	renderScreen = functools.partial(_renderScreen, renderState={})
+	if processes == 1 or not _isPicklable(renderOptions):
+		images = list(map(renderScreen, renderJobs))
+	else:
+		with multiprocessing.Pool(processes) as pool:
+			images = pool.map(renderScreen, renderJobs)
+	tty2img.clearCache()
 	
-	return mpy.concatenate_videoclips(clips)
+	return images, [ i for i, _ in clipsData ], [ duration for _, duration in clipsData ]
+
+class _ScreenSnapshot:
+	'''Picklable copy of pyte screen state (used by tty2img)'''
+	def __init__(self, screen):
+		self.columns = screen.columns
+		self.lines   = screen.lines
+		self.buffer  = { line: dict(screen.buffer[line]) for line in screen.buffer }
+		self.cursor  = types.SimpleNamespace(x=screen.cursor.x, y=screen.cursor.y, hidden=screen.cursor.hidden)
+
+def _isPicklable(obj):
+	try:
+		pickle.dumps(obj)
+		return True
+	except (pickle.PicklingError, AttributeError, TypeError):
+		return False
+
+def _renderScreen(renderJob, renderState):
+	screen, renderOptions = renderJob
+	return numpy.asarray( tty2img.tty2img(screen, renderState=renderState, **renderOptions) )
 
 def asciicast2video(
 		inputData,
@@ -107,7 +193,8 @@ def asciicast2video(
 		blinkingCursor = None,
 		lastFrameDuration = 3,
 		renderOptions = {},
-		continueOnLowMem = False
+		continueOnLowMem = False,
+		processes = 1
 	):
 	'''Convert asciicast data to moviepy video clip
 	
@@ -119,6 +206,8 @@ def asciicast2video(
 	          path to asciicast file (with first line as header) to open
 	      * multiline string ->
 	          content of asciicast file (with first line as header)
+	      * file object (e.g. opened file or io.StringIO) ->
+	          asciicast file to read (with first line as header)
 	      * list of strings ->
 	          each string is used as asciicast frame json (no header)
 	      * list of lists ->
@@ -141,23 +230,105 @@ def asciicast2video(
 		when False exit on low memory warring
 		when True  ignore low memory warring and continue rendering
 		when None  interactive ask
+	processes : int, optional
+	    number of processes used for rendering frames images
+	    when 1 (default) render in current process, when None use number of CPUs,
+	    pool is used only when renderOptions can be pickled (e.g. logFunction
+	    is not lambda) and needs `if __name__ == "__main__":` guard in caller
+	    script on platforms using spawn start method (Windows, macOS)
 	
 	Returns
 	-------
 	    moviepy video clip
 	'''
+	inputFrames, screen, stream = _loadAsciicast(
+		inputData, width, height, blinkingCursor, renderOptions, continueOnLowMem
+	)
 	
-	if isinstance(inputData, str):
-		if '\n' in inputData:
-			inputData = io.StringIO(inputData)
+	# render frames
+	return render_asciicast_frames(
+		inputFrames, screen, stream, blinkingCursor, lastFrameDuration, renderOptions, processes
+	)
+
+def asciicast2mp4(
+		inputData,
+		outputFile,
+		fps = 24,
+		codec = 'libx264',
+		width = None,
+		height = None,
+		blinkingCursor = None,
+		lastFrameDuration = 3,
+		renderOptions = {},
+		continueOnLowMem = False,
+		processes = 1
+	):
+	'''Convert asciicast data to video file
+	
+	Rendered frames are written directly to single ffmpeg process
+	(without creating moviepy video clip).
+	
+	Parameters
+	----------
+	inputData
+	    asciicast data (see asciicast2video)
+	outputFile : str
+	    path to output video file
+	fps : float, optional
+	    output video frame rate
+	codec : str, optional
+	    ffmpeg video codec
+	width, height, blinkingCursor, lastFrameDuration,
+	renderOptions, continueOnLowMem, processes
+	    see asciicast2video (including `if __name__ == "__main__":` guard
+	    requirement when processes is not 1)
+	'''
+	inputFrames, screen, stream = _loadAsciicast(
+		inputData, width, height, blinkingCursor, renderOptions, continueOnLowMem
+	)
+	images, imageIndexes, durations = _renderFrames(
+		inputFrames, screen, stream, blinkingCursor, lastFrameDuration, renderOptions, processes
+	)
+	
+	# number of video frames from video start to end of each subframe
+	# (video frame n is for time n/fps, like in moviepy write_videofile)
+	frameCounts = numpy.ceil(numpy.cumsum(durations) * fps).astype(int)
+	
+	size = (images[0].shape[1], images[0].shape[0])
+	writer = FFMPEG_VideoWriter(outputFile, size, fps, codec=codec)
+	try:
+		lastCount = 0
+		for i, count in zip(imageIndexes, frameCounts):
+			for _ in range(count - lastCount):
+				writer.write_frame(images[i])
+			lastCount = max(lastCount, count)
+	finally:
+		writer.close()
+
+def _loadAsciicast(inputData, width, height, blinkingCursor, renderOptions, continueOnLowMem):
+	'''Read asciicast data, create terminal emulator and check memory needs
+	(see asciicast2video)
+	
+	Returns
+	-------
+	    tuple (inputFrames, screen, stream)
+	'''
+	header = None
+	if isinstance(inputData, str) or hasattr(inputData, 'read'):
+		if not isinstance(inputData, str):
+			inputData = inputData.read().splitlines()
+		elif '\n' in inputData:
+			inputData = inputData.splitlines()
 		else:
-			inputData = open(inputData, 'r')
+			with open(inputData, 'r') as inputFile:
+				inputData = inputFile.read().splitlines()
+		header, inputData = inputData[0], inputData[1:]
 	
 	# when not set width and height, read its from first line
 	if not width or not height:
-		if isinstance(inputData, list):
+		if header is None:
 			raise BaseException("when inputData is list width and height must be set in args")
-		settings = json.loads(inputData.readline())
+		settings = _jsonLoads(header)
 		width  = settings['width']
 		height = settings['height']
 	
@@ -166,15 +337,15 @@ def asciicast2video(
 	stream = pyte.Stream(screen)
 	
 	# convert input to list of list
-	inputFrames = []
-	for frame in inputData:
-		if isinstance(frame, str):
-			frame = json.loads(frame)
-		inputFrames.append( (frame[0], frame[-1]) )
+	inputFrames = [
+		(frame[0], frame[-1]) for frame in (
+			_jsonLoads(frame) if isinstance(frame, str) else frame for frame in inputData
+		)
+	]
 	
 	# calculate memory needs
 	frameSize = tty2img.tty2img(screen, **renderOptions).size
-	frameSize = frameSize[0] * frameSize[1] * 4
+	frameSize = frameSize[0] * frameSize[1] * 3
 	frameCount = len(inputFrames)
 	if blinkingCursor:
 		frameCount += math.ceil( (inputFrames[-1][0] - inputFrames[0][0]) / (1.5 * blinkingCursor) )
@@ -203,10 +374,7 @@ def asciicast2video(
 	except FileNotFoundError:
 		pass
 	
-	# render frames
-	return render_asciicast_frames(
-		inputFrames, screen, stream, blinkingCursor, lastFrameDuration, renderOptions
-	)
+	return inputFrames, screen, stream
 
 def main():
 	import sys
@@ -215,8 +383,11 @@ def main():
 		print("USAGE: " + sys.argv[0] + " asciicast_file output_video_file")
 		sys.exit(1)
 	
-	video = asciicast2video(sys.argv[1], blinkingCursor=0.5, renderOptions={'fontSize':12}, continueOnLowMem=None)
-	video.write_videofile(sys.argv[2], fps=24)
+	if sys.argv[2].lower().endswith('.mp4'):
+		asciicast2mp4(sys.argv[1], sys.argv[2], fps=24, blinkingCursor=0.5, renderOptions={'fontSize':12}, continueOnLowMem=None, processes=None)
+	else:
+		video = asciicast2video(sys.argv[1], blinkingCursor=0.5, renderOptions={'fontSize':12}, continueOnLowMem=None, processes=None)
+		video.write_videofile(sys.argv[2], fps=24)
 
 if __name__ == "__main__":
 	main()
@@ -14,6 +14,7 @@ setuptools.setup(
     install_requires=[
         'pyte',
         'pillow',
+        'numpy',
         'fclist-cffi',
         'freetype-py'
     ],
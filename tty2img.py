@@ -3,14 +3,18 @@ rendering pyte terminal emulator screen as image
 
 Should be imported as a module and contains functions:
   * tty2img - convert pyte screen to PIL image
+  * clearCache - free cached lines layouts and text bitmaps
 
 Requires:
   * PIL (https://pypi.org/project/Pillow/) image library
   * pyte (https://pypi.org/project/pyte/) VTXXX terminal emulator
+  * numpy (https://pypi.org/project/numpy/) array computing (image buffer)
   * fclist (https://pypi.org/project/fclist-cffi/) fontconfig wrapper
     (optional, for support fallback fonts)
   * freetype (https://pypi.org/project/freetype-py/) freetype wrapper
     (optional, for support fallback fonts)
+  * cv2 (https://pypi.org/project/opencv-python/) OpenCV library
+    (optional, for faster antialiasing)
 
 Copyright © 2020-2021, Robert Ryszard Paciorek <rrp@opcode.eu.org>,
                        MIT licence
@@ -18,6 +22,9 @@ Copyright © 2020-2021, Robert Ryszard Paciorek <rrp@opcode.eu.org>,
 
 from PIL import Image, ImageDraw, ImageFont, ImageColor
 import pyte
+import numpy
+import functools
+import math
 
 try:
   import fclist
@@ -25,6 +32,11 @@ try:
 except ModuleNotFoundError:
   freetype = None
 
+try:
+  import cv2
+except ModuleNotFoundError:
+  cv2 = None
+
 def tty2img(
 		screen,
 		fgDefaultColor = '#00ff00',
@@ -39,10 +51,16 @@ def tty2img(
 		marginSize   = 5,
 		antialiasing = 0,
 		showCursor   = False,
-		logFunction  = None
+		logFunction  = None,
+		renderState  = None
 	):
 	'''Render pyte screen as PIL image
 	
+	When renderState is given, image buffer of previous call is reused, so when
+	rendering consecutive screens (with the same options) only changed lines
+	are redraw. Without renderState whole image is rendered in new buffer
+	(and function can be safely called from multiple threads).
+	
 	Parameters
 	----------
 	screen : pyte.Screen
@@ -74,17 +92,23 @@ def tty2img(
 	antialiasing : int, optional
 	    antialiasing level, when greater than 1 rendered image
 	    will be antialiasing times greater ans scale down
+	    (with cv2 INTER_AREA when OpenCV is available, otherwise
+	    with Pillow ANTIALIAS filter, so output depends on cv2 presence)
 	showCursor : bool, optional
 	    when true (and screen.cursor.hidden is false) mark cursor position
 	    by reverse foreground background color on it
 	logFunction : function
 	    function used to print some info and warnings,
 	    e.g. set to print for printing to stdout
+	renderState : dict, optional
+	    dict for keeping image buffer and lines state between consecutive
+	    calls (e.g. empty dict for first call), should not be shared by
+	    concurrently running calls
 	
 	Returns
 	-------
 	    PIL.Image
-	        with rendered terminal screen
+	        with rendered terminal screen (RGB mode)
 	'''
 	
 	if antialiasing > 1:
@@ -93,16 +117,13 @@ def tty2img(
 		fontSize     = fontSize * antialiasing
 	
 	# font settings
-	normalFont      = [ ImageFont.truetype(fontName, fontSize), None ]
-	boldFont        = [ ImageFont.truetype(boldFontName, fontSize), None ]
-	italicsFont     = [ ImageFont.truetype(italicsFontName, fontSize), None ]
-	boldItalicsFont = [ ImageFont.truetype(boldItalicsFontName, fontSize), None ]
+	normalFont      = _loadFont(fontName, fontSize)
+	boldFont        = _loadFont(boldFontName, fontSize)
+	italicsFont     = _loadFont(italicsFontName, fontSize)
+	boldItalicsFont = _loadFont(boldItalicsFontName, fontSize)
 	
-	if freetype:
-		normalFont[1]      = freetype.Face(normalFont[0].path)
-		boldFont[1]        = freetype.Face(boldFont[0].path)
-		italicsFont[1]     = freetype.Face(italicsFont[0].path)
-		boldItalicsFont[1] = freetype.Face(boldItalicsFont[0].path)
+	# fonts indexed by bold + 2*italics
+	fonts = (normalFont, boldFont, italicsFont, boldItalicsFont)
 	
 	# calculate single char and image size
 	charWidth, _ = normalFont[0].getsize('X')
@@ -110,94 +131,334 @@ def tty2img(
 	imgWidth     = charWidth  * screen.columns + 2*marginSize
 	imgHeight    = charHeight * screen.lines + 2*marginSize
 	
-	# create image object
-	image = Image.new('RGBA', (imgWidth, imgHeight), bgDefaultColor)
-	draw = ImageDraw.Draw(image)
-	
 	# cursor settings
 	showCursor = showCursor and (not screen.cursor.hidden)
 	
-	# draw full screen to image
-	for line in screen.buffer:
-		# process all characters in line
-		point, char, lchar = [marginSize, line*charHeight + marginSize], -1, -1
-		for char in sorted(screen.buffer[line].keys()):
-			cData = screen.buffer[line][char]
-			
-			# check for skipped chars (e.g. when use \t)
-			point[0] += charWidth * (char - lchar - 1)
-			lchar = char
-			
-			# check for empty char (bug in pyte?)
-			if cData.data == "":
-				continue
-			
-			# set colors and draw background
-			bgColor = cData.bg if cData.bg != 'default' else bgDefaultColor
-			fgColor = cData.fg if cData.fg != 'default' else fgDefaultColor
-			
-			if cData.reverse:
-				bgColor, fgColor = fgColor, bgColor
-			
-			if showCursor and line == screen.cursor.y and char == screen.cursor.x:
-				bgColor, fgColor = fgColor, bgColor
-			
-			bgColor = _convertColor(bgColor)
-			fgColor = _convertColor(fgColor)
-			
-			if bgColor != bgDefaultColor:
-				draw.rectangle( ((point[0], point[1]), (point[0] + charWidth, point[1] + charHeight)), fill=bgColor )
-			
-			# set font (bold / italics)
-			if cData.bold and cData.italics:
-				font = boldItalicsFont
-			elif cData.bold:
-				font = boldFont
-			elif cData.italics:
-				font = italicsFont
-			else:
-				font = normalFont
-			
-			# does font have this char?
-			extraWidth = 0
-			if freetype and not font[1].get_char_index(cData.data):
-				foundFont = False
-				for fname in fallbackFonts:
-					for ff in fclist.fclist(family=fname, charset=hex(ord(cData.data))):
-						foundFont = True
-						font = [ ImageFont.truetype(ff.file, fontSize), None ]
-						extraWidth = max(0, font[0].getsize(cData.data)[0] - charWidth)
-						break
-					if foundFont:
-						break
-				else:
-					if logFunction:
-						logFunction("Missing glyph for " + hex(ord(cData.data)) + " Unicode symbols (" + cData.data + ")")
+	# colors used for image buffer
+	bgDefaultRGB = _getColor(bgDefaultColor)
+	
+	# prepare lines drawing (line layouts are cached, so cells are processed
+	# only for lines with content not seen in previous renders)
+	layoutOptions = (
+		fonts, tuple(fallbackFonts), fontSize, charWidth, charHeight,
+		fgDefaultColor, bgDefaultColor
+	)
+	lineKeys = {}
+	cursorX, cursorY = screen.cursor.x, screen.cursor.y
+	for line, row in screen.buffer.items():
+		if line < screen.lines:
+			lineKeys[line] = (tuple(sorted(row.items())), cursorX if showCursor and line == cursorY else None)
+	
+	# image buffer and lines of previous call (with this same renderState)
+	# are reused when render options are the same, so only changed lines are redraw
+	renderKey = (layoutOptions, marginSize, imgWidth, imgHeight)
+	if renderState and renderState['renderKey'] == renderKey:
+		buffer, lastLayouts = renderState['buffer'], renderState['layouts']
+		lastKeys = renderState['lineKeys']
+		changed = { line for line in range(screen.lines) if lineKeys.get(line) != lastKeys.get(line) }
+	else:
+		buffer = numpy.empty((imgHeight, imgWidth, 3), dtype=numpy.uint8)
+		lastLayouts = {}
+		changed = set(range(screen.lines))
+	
+	# state is saved again after drawing all strips,
+	# so buffer of interrupted call will not be reused
+	if renderState is not None:
+		renderState.clear()
+	
+	layouts = {
+		line: lastLayouts[line] if line not in changed else _layoutLine(*key, *layoutOptions)
+		for line, key in lineKeys.items()
+	}
+	
+	# warnings are printed (for all lines) on every call, not only when layout is created
+	if logFunction:
+		for line in sorted(layouts):
+			for data in layouts[line][3]:
+				logFunction("Missing glyph for " + hex(ord(data)) + " Unicode symbols (" + data + ")")
+	
+	# text overflowing line height changes neighbour lines too
+	redraw = set(changed)
+	for line in changed:
+		for layout in (lastLayouts.get(line), layouts.get(line)):
+			if layout:
+				up, down = _overflowSpan(layout, charHeight)
+				redraw.update(range(line - up, line + down + 1))
+	
+	# number of neighbour lines which text can overflow into single strip
+	spanUp, spanDown = 0, 0
+	for layout in layouts.values():
+		up, down = _overflowSpan(layout, charHeight)
+		spanUp, spanDown = max(spanUp, up), max(spanDown, down)
+	
+	# draw lines strips
+	for line in sorted(redraw):
+		if line < 0 or line >= screen.lines:
+			continue
+		
+		# strip of image for this line (first and last include margins)
+		top    = 0 if line == 0 else marginSize + line*charHeight
+		bottom = imgHeight if line == screen.lines-1 else marginSize + (line+1)*charHeight
+		strip  = buffer[top:bottom]
+		
+		# fill default background and not default backgrounds (one slice assignment per run)
+		strip[...] = bgDefaultRGB
+		if line in layouts:
+			lineBgRuns, lineFgLines = layouts[line][:2]
+			y = marginSize + line*charHeight - top
+			for x0, x1, _, color in lineBgRuns:
+				strip[y:y+charHeight, marginSize+x0:marginSize+x1] = color
 			
 			# draw underscore and strikethrough
-			if cData.underscore:
-				draw.line(((point[0], point[1] + charHeight-1), (point[0] + charWidth, point[1] + charHeight-1)), fill=fgColor)
-				
-			if cData.strikethrough:
-				draw.line(((point[0], point[1] + charHeight//2), (point[0] + charWidth, point[1] + charHeight//2)), fill=fgColor)
-			
-			# draw text
-			draw.text(point, cData.data, fill=fgColor, font=font[0])
-			
-			# update next char position
-			point[0] += charWidth + extraWidth
+			for x0, x1, dy, color in lineFgLines:
+				strip[y+dy, marginSize+x0:marginSize+x1] = color
 		
-		# draw cursor when it is out of text range
-		if showCursor and line == screen.cursor.y and (not screen.cursor.x in screen.buffer[line]):
-			point[0] += (screen.cursor.x - char - 1) * charWidth
-			draw.rectangle( ((point[0], point[1]), (point[0] + charWidth, point[1] + charHeight)), fill=fgDefaultColor )
+		# draw text (one cached bitmap per run, also from neighbour lines overflowing this strip)
+		stripImage = Image.fromarray(strip, 'RGB').copy()
+		draw = ImageDraw.Draw(stripImage)
+		for textLine in range(line - spanDown, line + spanUp + 1):
+			if textLine in layouts:
+				y = marginSize + textLine*charHeight - top
+				for x, dy, mask, color in layouts[textLine][2]:
+					if y + dy < bottom - top and y + dy + mask.height > 0:
+						draw.bitmap((marginSize + x, y + dy), mask, fill=color)
+		strip[...] = numpy.asarray(stripImage)
+	
+	if renderState is not None:
+		renderState.update(renderKey=renderKey, buffer=buffer, lineKeys=lineKeys, layouts=layouts)
+	
+	image = Image.fromarray(buffer, 'RGB').copy()
 	
 	# return image
 	if antialiasing > 1:
-		return image.resize((imgWidth//antialiasing, imgHeight//antialiasing), Image.ANTIALIAS)
+		size = (imgWidth//antialiasing, imgHeight//antialiasing)
+		if cv2:
+			return Image.fromarray(cv2.resize(numpy.asarray(image), size, interpolation=cv2.INTER_AREA), 'RGB')
+		return image.resize(size, Image.ANTIALIAS)
 	else:
 		return image
 
+@functools.lru_cache(maxsize=256)
+def _layoutLine(
+		row, cursorX,
+		fonts, fallbackFonts, fontSize, charWidth, charHeight,
+		fgDefaultColor, bgDefaultColor
+	):
+	'''Prepare drawing of single screen line
+	
+	Results are cached for line content and render options,
+	so cells processing is done only for new lines.
+	
+	Parameters
+	----------
+	row : tuple
+	    sorted (column, pyte char data) items of screen line
+	cursorX : int or None
+	    column of cursor to mark in this line
+	fonts : tuple
+	    (PIL font, freetype face) pairs indexed by bold + 2*italics
+	fallbackFonts, fontSize, fgDefaultColor, bgDefaultColor
+	    see tty2img
+	charWidth, charHeight : int
+	    single char size in pixels
+	
+	Returns
+	-------
+	    tuple (bgRuns, fgLines, textMasks, missingChars)
+	        with lists of (x0, x1, y, rgb), (x0, x1, y, rgb)
+	        and (x, y, mask, rgb), coordinates are relative to line begin,
+	        and list of chars without glyph in fonts and fallback fonts
+	'''
+	bgDefaultRGB = _getColor(bgDefaultColor)
+	bgRuns   = []  # [x0, x1, y, rgb] of runs of cells with not default background
+	fgLines  = []  # [x0, x1, y, rgb] of underscore and strikethrough lines
+	textRuns = []  # [x, font, rgb, [chars]] of text with this same font and color
+	missingChars = []  # chars without glyph in any font (for logFunction in tty2img)
+	
+	# chars missing in fonts (glyph check once per unique font and char in line)
+	missingGlyphs = set()
+	if freetype:
+		lineGlyphs = { (cData.bold + 2*cData.italics, cData.data) for _, cData in row if cData.data }
+		missingGlyphs = { glyph for glyph in lineGlyphs if not fonts[glyph[0]][1].get_char_index(glyph[1]) }
+	
+	# process all characters in line
+	x, char, lchar = 0, -1, -1
+	for char, cData in row:
+		data = cData.data
+		
+		# check for skipped chars (e.g. when use \t)
+		x += charWidth * (char - lchar - 1)
+		lchar = char
+		
+		# check for empty char (bug in pyte?)
+		if data == "":
+			continue
+		
+		# set colors
+		bgColor, fgColor = cData.bg, cData.fg
+		if bgColor == 'default':
+			bgColor = bgDefaultColor
+		if fgColor == 'default':
+			fgColor = fgDefaultColor
+		
+		if cData.reverse:
+			bgColor, fgColor = fgColor, bgColor
+		
+		if char == cursorX:
+			bgColor, fgColor = fgColor, bgColor
+		
+		bgColor = _getColor(bgColor)
+		fgColor = _getColor(fgColor)
+		
+		if bgColor != bgDefaultRGB:
+			_addRun(bgRuns, x, x + charWidth, 0, bgColor)
+		
+		# set font (bold / italics)
+		fontIndex = cData.bold + 2*cData.italics
+		font = fonts[fontIndex]
+		
+		# does font have this char?
+		extraWidth = 0
+		if (fontIndex, data) in missingGlyphs:
+			fallbackFont = _findFallbackFont(data, fallbackFonts, fontSize)
+			if fallbackFont:
+				font = fallbackFont
+				extraWidth = max(0, font[0].getsize(data)[0] - charWidth)
+			else:
+				missingChars.append(data)
+		
+		# underscore and strikethrough
+		if cData.underscore:
+			_addRun(fgLines, x, x + charWidth, charHeight-1, fgColor)
+		
+		if cData.strikethrough:
+			_addRun(fgLines, x, x + charWidth, charHeight//2, fgColor)
+		
+		# text (join to previous run when it is next char with this same font and color,
+		#       spaces can be joined to any run)
+		run = textRuns[-1] if textRuns else None
+		if run and run[0] + len(run[3]) * charWidth == x and \
+		  (data == " " or (run[1] is font[0] and run[2] == fgColor)):
+			run[3].append(data)
+		elif data != " ":
+			textRuns.append([x, font[0], fgColor, [data]])
+		
+		# update next char position
+		x += charWidth + extraWidth
+	
+	# cursor when it is out of text range
+	if cursorX is not None and cursorX not in [ c for c, _ in row ]:
+		x += (cursorX - char - 1) * charWidth
+		_addRun(bgRuns, x, x + charWidth, 0, _getColor(fgDefaultColor))
+	
+	# text bitmaps
+	textMasks = []
+	for x, font, color, chars in textRuns:
+		while chars[-1] == " ":
+			chars.pop()
+		text = _renderText(font, tuple(chars), charWidth)
+		if text:
+			textMasks.append((x + text[1][0], text[1][1], text[0], color))
+	
+	return bgRuns, fgLines, textMasks, missingChars
+
+def _overflowSpan(layout, charHeight):
+	'''Return number of lines above and below which line text (from _layoutLine) overflows'''
+	up, down = 0, 0
+	for _, dy, mask, _ in layout[2]:
+		up   = max(up, math.ceil(-dy / charHeight))
+		down = max(down, math.ceil((dy + mask.height) / charHeight) - 1)
+	return up, down
+
+@functools.lru_cache(maxsize=1024)
+def _findFallbackFont(char, fallbackFonts, fontSize):
+	'''Find font with glyph for char in fallbackFonts families
+	
+	Returns
+	-------
+	    tuple (PIL font, freetype face)
+	        loaded by _loadFont, so each font file is opened only once
+	    None
+	        when none of fallbackFonts has this glyph
+	'''
+	for fname in fallbackFonts:
+		for ff in fclist.fclist(family=fname, charset=hex(ord(char))):
+			return _loadFont(ff.file, fontSize)
+	return None
+
+@functools.lru_cache(maxsize=64)
+def _loadFont(fontName, fontSize):
+	# (PIL font, freetype face) pair
+	font = ImageFont.truetype(fontName, fontSize)
+	return font, freetype.Face(font.path) if freetype else None
+
+@functools.lru_cache(maxsize=4096)
+def _renderGlyph(font, char):
+	'''Render char as alpha mask (once per font and char)
+	
+	Returns
+	-------
+	    tuple (PIL.Image, (x, y))
+	        with mask for ImageDraw.bitmap and its offset from text point
+	    None
+	        for chars without visible pixels (e.g. space)
+	'''
+	left, top, right, bottom = font.getbbox(char)
+	if right <= left or bottom <= top:
+		return None
+	mask = Image.new('L', (right - left, bottom - top), 0)
+	ImageDraw.Draw(mask).text((-left, -top), char, fill=255, font=font)
+	return mask, (left, top)
+
+@functools.lru_cache(maxsize=512)
+def _renderText(font, chars, charWidth):
+	'''Render chars (tuple of cells content) as alpha mask,
+	char i is placed at i*charWidth (as on terminal screen)
+	
+	Returns
+	-------
+	    tuple (PIL.Image, (x, y)) or None
+	        see _renderGlyph
+	'''
+	glyphs = [ (i * charWidth, _renderGlyph(font, char)) for i, char in enumerate(chars) ]
+	glyphs = [ (x + glyph[1][0], glyph[1][1], glyph[0]) for x, glyph in glyphs if glyph ]
+	if not glyphs:
+		return None
+	if len(glyphs) == 1:
+		return glyphs[0][2], glyphs[0][:2]
+	
+	left   = min(x for x, _, _ in glyphs)
+	top    = min(y for _, y, _ in glyphs)
+	right  = max(x + glyph.width for x, _, glyph in glyphs)
+	bottom = max(y + glyph.height for _, y, glyph in glyphs)
+	mask = Image.new('L', (right - left, bottom - top), 0)
+	for x, y, glyph in glyphs:
+		mask.paste(255, (x - left, y - top), glyph)
+	return mask, (left, top)
+
+def clearCache():
+	'''Free cached lines layouts and text bitmaps
+	
+	Cached data (with alpha masks for whole text runs, large when using
+	antialiasing) are kept between tty2img calls until cache size limits,
+	this can be used to release memory after rendering series of screens.
+	'''
+	_layoutLine.cache_clear()
+	_renderText.cache_clear()
+	_renderGlyph.cache_clear()
+
+def _addRun(runs, x0, x1, y, color):
+	# extend previous run (line or background) when it ends at x0
+	if runs and runs[-1][1] == x0 and runs[-1][2] == y and runs[-1][3] == color:
+		runs[-1][1] = x1
+	else:
+		runs.append([x0, x1, y, color])
+
+@functools.lru_cache(maxsize=1024)
+def _getColor(color):
+	# color name or value from pyte to RGB tuple
+	return ImageColor.getcolor(_convertColor(color), 'RGB')
+
 def _convertColor(color):
 	if color[0] != "#" and not color in ImageColor.colormap:
 		return "#" + color